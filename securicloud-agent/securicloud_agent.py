@@ -1,6 +1,9 @@
+import base64
+import collections
 import contextlib
 import os
 import secrets
+import socket
 import ssl
 import struct
 import time
@@ -8,8 +11,6 @@ import requests
 import asyncio
 import json
 import signal
-import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
 from pathlib import Path
 import urllib.parse
 
@@ -19,11 +20,20 @@ BACKUP_TUNNEL_HOST = ["tunnel.securicloud.me", "443", 0]
 
 REDIRECT_PORT = 8099
 
+CHUNK_SIZE = 8192
+WRITE_HWM = 64 * 1024
+HEARTBEAT_INTERVAL = 5
+MAX_POOLED_BUFS = 32
+
+# Tunnel frame header: type (1 byte), payload length (2 bytes, big-endian)
+_HDR = struct.Struct(">BH")
+
 stopping = asyncio.Event()
 _live = set()
-_httpd = None
-
-ssl_ctx = ssl.create_default_context()
+_ingress_server = None
+_buf_pool = collections.deque()
+_supervisor = None
+_tls_last = {}
 
 
 # -----------------------------------------------------------------------------
@@ -38,6 +48,19 @@ def debug(msg: str):
         print("[DEBUG]", msg)
 
 
+# -----------------------------------------------------------------------------
+# SUPERVISOR SESSION
+# -----------------------------------------------------------------------------
+
+def supervisor_session():
+    """Shared keep-alive session for all Supervisor API calls."""
+    global _supervisor
+    if _supervisor is None:
+        _supervisor = requests.Session()
+        _supervisor.headers["Authorization"] = f"Bearer {os.getenv('SUPERVISOR_TOKEN')}"
+    return _supervisor
+
+
 # -----------------------------------------------------------------------------
 # SUPERVISOR RESTART
 # -----------------------------------------------------------------------------
@@ -51,7 +74,7 @@ def restart_addon():
             return
 
         url = "http://supervisor/addons/self/restart"
-        r = requests.post(url, headers={"Authorization": f"Bearer {token}"}, timeout=5)
+        r = supervisor_session().post(url, timeout=5)
 
         if r.status_code == 200:
             log("[RESTART] Add-on restart triggered.")
@@ -67,12 +90,71 @@ def restart_addon():
 # -----------------------------------------------------------------------------
 
 def spawn(coro):
+    # _live holds the only strong reference to fire-and-forget tasks; the
+    # event loop itself keeps tasks only weakly.
     task = asyncio.create_task(coro)
     _live.add(task)
-    task.add_done_callback(lambda t: (_live.discard(t), debug(f"Live tasks: {len(_live)}")))
+    task.add_done_callback(_live.discard)
+    if DEBUG:
+        task.add_done_callback(lambda _: debug(f"Live tasks: {len(_live)}"))
     return task
 
 
+# -----------------------------------------------------------------------------
+# TLS SESSION RESUMPTION
+# -----------------------------------------------------------------------------
+
+class ResumingSSLContext(ssl.SSLContext):
+    """Client context that offers the last session for a host on reconnect.
+
+    asyncio creates its SSLObject via wrap_bio() without a session, so the
+    session is injected here. It is read from the previous connection's
+    SSLObject at reconnect time, when TLS 1.3 tickets have arrived.
+    """
+
+    def wrap_bio(self, incoming, outgoing, server_side=False,
+                 server_hostname=None, session=None):
+        last = _tls_last.get(server_hostname)
+        if session is None and last is not None:
+            with contextlib.suppress(Exception):
+                session = last.session
+        return super().wrap_bio(incoming, outgoing, server_side,
+                                server_hostname, session)
+
+
+ssl_ctx = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+ssl_ctx.load_default_certs()
+
+
+# -----------------------------------------------------------------------------
+# BUFFER POOL
+# -----------------------------------------------------------------------------
+
+def acquire_buf():
+    """Returns a frame buffer: 3-byte header followed by CHUNK_SIZE payload."""
+    try:
+        return _buf_pool.pop()
+    except IndexError:
+        return bytearray(3 + CHUNK_SIZE)
+
+def release_buf(buf):
+    if len(_buf_pool) < MAX_POOLED_BUFS:
+        _buf_pool.append(buf)
+
+
+# -----------------------------------------------------------------------------
+# SOCKET TUNING
+# -----------------------------------------------------------------------------
+
+def enable_keepalive(sock):
+    """Let the kernel probe idle peers instead of polling from Python."""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 5)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+
+
 # -----------------------------------------------------------------------------
 # SIGNAL HANDLING
 # -----------------------------------------------------------------------------
@@ -93,11 +175,7 @@ def discover_local_ha():
 
     if api and token:
         try:
-            r = requests.get(
-                f"{api}/core/info",
-                headers={"Authorization": f"Bearer {token}"},
-                timeout=5
-            )
+            r = supervisor_session().get(f"{api}/core/info", timeout=5)
             d = r.json().get("data", {})
             return d.get("host", "127.0.0.1"), int(d.get("port", 8123))
         except Exception as e:
@@ -119,9 +197,9 @@ def get_ha_instance_id():
             except Exception:
                 pass
 
-        # generate 25-char base36 ID
-        base36 = "0123456789abcdefghijklmnopqrstuvwxyz"
-        new_id = ''.join(secrets.choice(base36) for _ in range(25))
+        # generate 25-char ID from one urandom read; lowercase base32
+        # (a-z, 2-7) stays within the base36 alphabet
+        new_id = base64.b32encode(secrets.token_bytes(16)).decode("ascii").lower()[:25]
         path.write_text(json.dumps({"instance_id": new_id}))
         return new_id
 
@@ -133,22 +211,51 @@ def get_ha_instance_id():
 # TUNNEL CODE 
 # -----------------------------------------------------------------------------
 
-async def pipe_tunnel_to_ha(t_reader, t_writer, ha_writer, header):
+async def open_ha_socket():
+    """Connects a raw non-blocking socket to HA, driven by loop.sock_* calls."""
+    loop = asyncio.get_running_loop()
+    infos = await loop.getaddrinfo(LOCAL_HA[0], LOCAL_HA[1], type=socket.SOCK_STREAM)
+
+    # try each resolved address in turn, like asyncio.open_connection
+    last_error = None
+    for family, type, proto, _, addr in infos:
+        sock = socket.socket(family, type, proto)
+        try:
+            sock.setblocking(False)
+            await loop.sock_connect(sock, addr)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            enable_keepalive(sock)
+            return sock
+        except OSError as e:
+            sock.close()
+            last_error = e
+        except BaseException:
+            sock.close()
+            raise
+
+    raise last_error
+
+
+def cancel_peer(session):
+    """Called first in a pipe's finally: stops the other direction."""
+    current = asyncio.current_task()
+    if current.cancelling():
+        return  # the peer is the one tearing us down
+    for task in session:
+        if task is not current and not task.done():
+            task.cancel()
+
+
+async def pipe_tunnel_to_ha(t_reader, ha_sock, header, session):
+    loop = asyncio.get_running_loop()
     try:
         while not stopping.is_set():
-            type, length = struct.unpack(">BH", header)
+            type, length = _HDR.unpack(header)
             data = await t_reader.readexactly(length)
             if type == 0:
-                ha_writer.write(data)
-                await ha_writer.drain()
+                await loop.sock_sendall(ha_sock, data)
 
-            while not stopping.is_set():
-                try:
-                    header = await asyncio.wait_for(t_reader.readexactly(3), 5)
-                    break
-                except asyncio.TimeoutError:
-                    t_writer.write(b"\x00\x00\x00")
-                    await t_writer.drain()
+            header = await t_reader.readexactly(3)
 
     except asyncio.CancelledError:
         pass
@@ -156,22 +263,42 @@ async def pipe_tunnel_to_ha(t_reader, t_writer, ha_writer, header):
         pass
 
     finally:
-        if not ha_writer.is_closing():
-            ha_writer.close()
-            with contextlib.suppress(Exception):
-                await ha_writer.wait_closed()
-
-
-async def pipe_ha_to_tunnel(ha_reader, t_writer):
+        cancel_peer(session)
+        # The socket itself is closed by handle_active_connection once both
+        # pipes are done, so the peer never reads from a closed descriptor.
+        with contextlib.suppress(OSError):
+            ha_sock.shutdown(socket.SHUT_WR)
+
+
+async def pipe_ha_to_tunnel(ha_sock, t_writer, session):
+    # buf holds the 3-byte frame header followed by the payload, so each
+    # chunk goes out with a single write.
+    loop = asyncio.get_running_loop()
+    buf = acquire_buf()
+    mv = memoryview(buf)
+    payload = mv[3:]
     try:
         while not stopping.is_set():
-            data = await ha_reader.read(8192)
-            if not data:
+            n = await loop.sock_recv_into(ha_sock, payload)
+            if n == 0:
                 break
-            header = struct.pack(">BH", 0, len(data))
-            t_writer.write(header)
-            t_writer.write(data)
-            await t_writer.drain()
+            _HDR.pack_into(buf, 0, 0, n)
+            t_writer.write(mv[:3 + n])
+
+            queued = t_writer.transport.get_write_buffer_size()
+            if queued:
+                # The transport may still hold a view into buf rather than a
+                # copy, so leave buf to it and continue with a fresh one.
+                # This is conservative: for TLS the size also counts bytes
+                # already encrypted (copies), so under backpressure most
+                # swaps are unneeded and each takes another buffer from the
+                # pool (pooled buffers are never held by a transport).
+                buf = acquire_buf()
+                mv = memoryview(buf)
+                payload = mv[3:]
+                # only yield for backpressure once enough has queued up
+                if queued > WRITE_HWM:
+                    await t_writer.drain()
 
     except asyncio.CancelledError:
         pass
@@ -179,6 +306,10 @@ async def pipe_ha_to_tunnel(ha_reader, t_writer):
         pass
 
     finally:
+        cancel_peer(session)
+        # buf is never referenced by the transport here: a queued one was
+        # swapped out above, so it is safe to hand to another session.
+        release_buf(buf)
         if not t_writer.is_closing():
             t_writer.close()
             with contextlib.suppress(Exception):
@@ -186,33 +317,48 @@ async def pipe_ha_to_tunnel(ha_reader, t_writer):
 
 
 async def handle_active_connection(t_reader, t_writer, header):
-    ha_reader = ha_writer = None
+    ha_sock = None
 
     try:
         debug("[FORWARD] Opening HA connection…")
-        ha_reader, ha_writer = await asyncio.open_connection(LOCAL_HA[0], LOCAL_HA[1])
-
-        t1 = spawn(pipe_tunnel_to_ha(t_reader, t_writer, ha_writer, header))
-        t2 = spawn(pipe_ha_to_tunnel(ha_reader, t_writer))
+        ha_sock = await open_ha_socket()
 
-        done, pending = await asyncio.wait({t1, t2}, return_when=asyncio.FIRST_COMPLETED)
-        for p in pending:
-            p.cancel()
-        await asyncio.gather(*pending, return_exceptions=True)
+        # whichever direction ends first cancels the other via the session
+        session = []
+        async with asyncio.TaskGroup() as tg:
+            session.append(tg.create_task(pipe_tunnel_to_ha(t_reader, ha_sock, header, session)))
+            session.append(tg.create_task(pipe_ha_to_tunnel(ha_sock, t_writer, session)))
 
     except Exception as e:
         log(f"[FORWARD] Error: {e}")
 
     finally:
-        for w in (t_writer, ha_writer):
-            if w:
-                with contextlib.suppress(Exception):
-                    w.close()
-                    await w.wait_closed()
+        with contextlib.suppress(Exception):
+            t_writer.close()
+            await t_writer.wait_closed()
+        if ha_sock:
+            ha_sock.close()
 
         debug("[FORWARD] Session closed")
 
 
+async def heartbeat(w):
+    """Sends an empty frame every HEARTBEAT_INTERVAL seconds so the server,
+    and any proxy in front of it, sees the connection as alive."""
+    try:
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            if w.is_closing():
+                break
+            if stopping.is_set():
+                w.close()  # wakes the blocked reader on this connection
+                break
+            w.write(b"\x00\x00\x00")
+            await w.drain()
+    except Exception:
+        pass
+
+
 async def keep_idle_connection(print_conn_logs):
     while not stopping.is_set():
         try:
@@ -220,12 +366,13 @@ async def keep_idle_connection(print_conn_logs):
                 log(f"[IDLE] Connecting...")
 
             r, w = await connect_to_host()
+            sock = w.get_extra_info("socket")
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            enable_keepalive(sock)
 
-            id = HA_INSTANCE_ID.encode()
-            h = struct.pack(">BH", 0, len(id))
-            w.write(h)
-            w.write(id)
+            w.write(HANDSHAKE_FRAME)
             await w.drain()
+            spawn(heartbeat(w))
 
             if print_conn_logs or DEBUG:
                 log("[IDLE] Connected. The service is running…")
@@ -233,17 +380,13 @@ async def keep_idle_connection(print_conn_logs):
 
             header = None
             while not stopping.is_set():
-                try:
-                    header = await asyncio.wait_for(r.readexactly(3), 5)
-                    type, length = struct.unpack(">BH", header)
-                    if type != 0:
-                        data = await r.readexactly(length)
-                        spawn(handleSpecialFrame(type, data))
-                        continue
-                    break
-                except asyncio.TimeoutError:
-                    w.write(b"\x00\x00\x00")
-                    await w.drain()
+                header = await r.readexactly(3)
+                type, length = _HDR.unpack(header)
+                if type != 0:
+                    data = await r.readexactly(length)
+                    spawn(handleSpecialFrame(type, data))
+                    continue
+                break
 
             if header is None or stopping.is_set():
                 w.close()
@@ -255,6 +398,8 @@ async def keep_idle_connection(print_conn_logs):
             break
 
         except Exception as e:
+            if stopping.is_set():
+                break
             log(f"[IDLE] Error: {e}, retrying in 3s")
             print_conn_logs = True
             await asyncio.sleep(3)
@@ -280,6 +425,7 @@ async def connect_to_host():
                             server_hostname=host[0]
                         ), 3)
                 host[2] = 0
+                _tls_last[host[0]] = w.get_extra_info("ssl_object")
                 return r, w
             except asyncio.CancelledError:
                 raise
@@ -297,12 +443,10 @@ async def connect_to_host():
 # INGRESS UI
 # -----------------------------------------------------------------------------
 
-class RedirectHandler(BaseHTTPRequestHandler):
+# FULL POLISHED MAIN PAGE ---------------------------------------------------
 
-    # FULL POLISHED MAIN PAGE -------------------------------------------------
-
-    def build_main_page(self) -> str:
-        return f"""<!DOCTYPE html>
+def build_main_page() -> str:
+    return f"""<!DOCTYPE html>
 <html>
 <head>
 <meta charset="utf-8">
@@ -366,11 +510,12 @@ class RedirectHandler(BaseHTTPRequestHandler):
 </body>
 </html>
 """
-    
-    # CONFIRMATION PAGE -------------------------------------------------------
 
-    def build_confirm_page(self) -> str:
-        return """<!DOCTYPE html>
+
+# CONFIRMATION PAGE ---------------------------------------------------------
+
+def build_confirm_page() -> str:
+    return """<!DOCTYPE html>
 <html>
 <head>
 <meta charset="utf-8">
@@ -437,10 +582,11 @@ class RedirectHandler(BaseHTTPRequestHandler):
 </html>
 """
 
-    # RESET PAGE WITH AUTO-REFRESH -------------------------------------------
 
-    def build_reset_done_page(self) -> str:
-        return """<!DOCTYPE html>
+# RESET PAGE WITH AUTO-REFRESH ----------------------------------------------
+
+def build_reset_done_page() -> str:
+    return """<!DOCTYPE html>
 <html>
 <head>
 <meta charset="utf-8">
@@ -480,79 +626,114 @@ setInterval(checkAlive, 3000);
 </html>
 """
 
-    # -------------------------------------------------------------------------
-    # ROUTING
-    # -------------------------------------------------------------------------
 
-    def do_GET(self):
-        parsed = urllib.parse.urlparse(self.path)
-        clean = parsed.path.rstrip("/")
+def cache_page(html: str) -> bytes:
+    """Encode a page once as a complete HTTP response."""
+    body = html.encode()
+    head = (
+        "HTTP/1.1 200 OK\r\n"
+        "Content-Type: text/html; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n"
+        "\r\n"
+    )
+    return head.encode() + body
 
-        if clean.endswith("reset-confirm"):
-            return self.respond_html(self.build_confirm_page())
 
-        if clean.endswith("reset-now"):
-            return self.handle_reset_now()
+NOT_IMPLEMENTED = (
+    b"HTTP/1.1 501 Not Implemented\r\n"
+    b"Content-Length: 0\r\n"
+    b"Connection: close\r\n"
+    b"\r\n"
+)
 
-        if clean.endswith("check-ready"):
-            return self.respond_html(self.build_reset_done_page())
 
-        # MAIN PAGE
-        return self.respond_html(self.build_main_page())
+# -----------------------------------------------------------------------------
+# REQUEST HANDLER
+# -----------------------------------------------------------------------------
 
-    # -------------------------------------------------------------------------
+async def handle_ingress_request(reader, writer):
+    """Serves a single GET per connection, then closes it."""
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 10)
+        parts = head[:head.index(b"\r\n")].split()
 
-    def respond_html(self, html: str):
-        body = html.encode()
-        self.send_response(200)
-        self.send_header("Content-Type", "text/html; charset=utf-8")
-        self.send_header("Content-Length", str(len(body)))
-        self.end_headers()
-        self.wfile.write(body)
+        if len(parts) < 2 or parts[0] != b"GET":
+            writer.write(NOT_IMPLEMENTED)
+        else:
+            await route_get(parts[1].decode("latin-1"), writer)
+        await writer.drain()
 
-    # -------------------------------------------------------------------------
+    except Exception:
+        pass
 
-    def handle_reset_now(self):
-        """Delete ID file, show restart page, trigger restart."""
-        try:
-            p = Path("/share/ha_instance_id.json")
-            if p.exists():
-                p.unlink()
-            log("[RESET] Instance ID file deleted.")
-        except Exception as e:
-            log(f"[RESET] Error deleting file: {e}")
+    finally:
+        writer.close()
+        with contextlib.suppress(Exception):
+            await writer.wait_closed()
 
-        # Show restart UI first
-        self.respond_html(self.build_reset_done_page())
 
-        # Restart in background
-        threading.Thread(target=restart_addon, daemon=True).start()
+# -----------------------------------------------------------------------------
+# ROUTING
+# -----------------------------------------------------------------------------
+
+async def route_get(target: str, writer):
+    clean = urllib.parse.urlparse(target).path.rstrip("/")
 
-    def log_message(self, *args):
-        return  # silence HTTP logs
+    if clean.endswith("reset-confirm"):
+        return writer.write(CONFIRM_PAGE)
+
+    if clean.endswith("reset-now"):
+        return await handle_reset_now(writer)
+
+    if clean.endswith("check-ready"):
+        return writer.write(RESET_DONE_PAGE)
+
+    # MAIN PAGE
+    return writer.write(MAIN_PAGE)
+
+
+# -----------------------------------------------------------------------------
+
+async def handle_reset_now(writer):
+    """Delete ID file, show restart page, trigger restart."""
+    try:
+        p = Path("/share/ha_instance_id.json")
+        if p.exists():
+            p.unlink()
+        log("[RESET] Instance ID file deleted.")
+    except Exception as e:
+        log(f"[RESET] Error deleting file: {e}")
+
+    # Show restart UI first
+    writer.write(RESET_DONE_PAGE)
+    await writer.drain()
+
+    # Restart in background
+    spawn(asyncio.to_thread(restart_addon))
 
 
 # -----------------------------------------------------------------------------
 # INGRESS SERVER
 # -----------------------------------------------------------------------------
 
-def start_ingress_redirect_server():
-    global _httpd
+async def start_ingress_redirect_server():
+    global _ingress_server
     try:
         log(f"[INGRESS] Starting admin UI on {REDIRECT_PORT}")
-        _httpd = HTTPServer(("0.0.0.0", REDIRECT_PORT), RedirectHandler)
+        _ingress_server = await asyncio.start_server(
+            handle_ingress_request, "0.0.0.0", REDIRECT_PORT
+        )
         log("[INGRESS] Ready")
-        _httpd.serve_forever()
     except Exception as e:
         log(f"[INGRESS] Failed to start admin UI: {e}")
 
 
 def stop_ingress_redirect_server():
-    global _httpd
-    if _httpd:
+    if _ingress_server:
         with contextlib.suppress(Exception):
             log("[INGRESS] Shutting down admin UI")
-            _httpd.shutdown()
+            _ingress_server.close()
 
 
 # -----------------------------------------------------------------------------
@@ -560,15 +741,19 @@ def stop_ingress_redirect_server():
 # -----------------------------------------------------------------------------
 
 async def main():
-    signal.signal(signal.SIGTERM, handle_stop)
-    signal.signal(signal.SIGINT, handle_stop)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, handle_stop)
+        except NotImplementedError:
+            signal.signal(sig, handle_stop)
 
     log(f"[INFO] Instance registration URL: {regAgentUrl}")
 
-    threading.Thread(target=start_ingress_redirect_server, daemon=True).start()
+    await start_ingress_redirect_server()
     spawn(keep_idle_connection(True))
 
-    await asyncio.Event().wait()
+    await stopping.wait()
 
 
 # -----------------------------------------------------------------------------
@@ -578,14 +763,9 @@ async def main():
 HA_BASE = "http://supervisor/core"
 SUPERVISOR_TOKEN = os.environ["SUPERVISOR_TOKEN"]
 
-HEADERS = {
-    "Authorization": f"Bearer {SUPERVISOR_TOKEN}",
-    "Content-Type": "application/json",
-}
-
 def call_ha_service(domain: str, service: str, payload: dict):
     url = f"{HA_BASE}/api/services/{domain}/{service}"
-    r = requests.post(url, json=payload, headers=HEADERS, timeout=5)
+    r = supervisor_session().post(url, json=payload, timeout=5)
     r.raise_for_status()
 
 
@@ -631,7 +811,13 @@ def handle_notification(msg: dict):
 
 LOCAL_HA = discover_local_ha()
 HA_INSTANCE_ID = get_ha_instance_id()
+_ident = HA_INSTANCE_ID.encode()
+HANDSHAKE_FRAME = _HDR.pack(0, len(_ident)) + _ident
 regAgentUrl = f"https://securicloud.me/add-agent/home_assistant/{HA_INSTANCE_ID}"
 controlPanelUrl = f"https://securicloud.me/portal"
 
+MAIN_PAGE = cache_page(build_main_page())
+CONFIRM_PAGE = cache_page(build_confirm_page())
+RESET_DONE_PAGE = cache_page(build_reset_done_page())
+
 asyncio.run(main())